@@ -1,9 +1,14 @@
 import redis
 import json
+import logging
 
-from typing import List
-from fastapi import FastAPI, HTTPException, Request, Depends, UploadFile, File
-from fastapi.responses import JSONResponse, Response
+from redis.exceptions import LockError, LockNotOwnedError
+
+from typing import List, Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import FastAPI, HTTPException, Request, Depends, UploadFile, File, BackgroundTasks
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 from fastapi.middleware.cors import CORSMiddleware
@@ -12,14 +17,18 @@ from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Counter
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from .utils import process_transactions
-from .users import User, UserLogin, Profile
+from .feed import stream_feed, publish_transaction, publish_balance
+from .database import engine_for, mark_write, rd as async_rd
+from .users import User, UserLogin, UserPublic, Profile
 from .schemas import Transaction
-from .settings import JWT_EXPIRE, ADMIN_PASSWORD, ADMIN_USERNAME, Settings
+from .settings import JWT_EXPIRE, ADMIN_PASSWORD, ADMIN_USERNAME, REDIS_HOST, REDIS_PORT, ARCHIVE_HORIZON_DAYS, ARCHIVE_LOCK_SECONDS, Settings
 
 
 app = FastAPI()
 
-rd = redis.Redis(host='redis', port=6379, db=0, charset="utf-8", decode_responses=True)
+logger = logging.getLogger(__name__)
+
+rd = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, charset="utf-8", decode_responses=True)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +36,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 transaction_create = Counter('transaction_create_total', 'Total Transaction created', ['method', 'endpoint'])
@@ -37,6 +47,10 @@ Instrumentator().instrument(app).expose(app)
 def get_config():
     return Settings()
 
+@app.on_event("startup")
+async def create_indexes():
+    await User.create_indexes()
+
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(
@@ -81,14 +95,28 @@ async def create_user(user: User, Authorize: AuthJWT = Depends()):
         return user
     raise HTTPException(status_code=401, detail=f"Username {user.username} already exists. Please use another one.")
 
-@app.get('/users', response_description="list users", response_model=List[User])
-async def list_users(Authorize: AuthJWT = Depends()):
+@app.get('/users', response_description="list users", response_model=List[UserPublic])
+async def list_users(response: Response, after: str = None, limit: int = 100, profile: Optional[Profile] = None, username_prefix: str = None, format: str = "json", Authorize: AuthJWT = Depends()):
     Authorize.jwt_required()
     current_profile = Authorize.get_raw_jwt().get('profile')
-    if current_profile == Profile.admin:
-        users = await User.all()
-        return users
-    raise HTTPException(status_code=401, detail="You don´t have permissions to do this action.")
+    if current_profile != Profile.admin:
+        raise HTTPException(status_code=401, detail="You don´t have permissions to do this action.")
+    if after:
+        try:
+            ObjectId(after)
+        except InvalidId:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor {after}")
+    if format == "ndjson":
+        async def users_ndjson():
+            async for user in User.iter_public(after=after, profile=profile, username_prefix=username_prefix):
+                yield user.json() + "\n"
+        return StreamingResponse(users_ndjson(), media_type="application/x-ndjson")
+    limit = max(1, min(limit, 1000))
+    users = await User.list_public(after=after, limit=limit, profile=profile, username_prefix=username_prefix)
+    # The cursor for the next page goes in a header so the body stays a plain list
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = users[-1].id
+    return users
 
 @app.get("/users/{user_id}", response_description="show a single user", response_model=User)
 async def show_user(user_id: str, Authorize: AuthJWT = Depends()):
@@ -137,6 +165,8 @@ async def upload_transactions(file: UploadFile = File(...), Authorize: AuthJWT =
     content = await file.read()
     transactions_list = json.loads(content.decode('utf-8'))
 
+    # Reads during and right after the upload must see it, route them to the primary
+    await mark_write(current_user_id)
     user = await User.get(idx=current_user_id)
     user.balance += sum(t["amount"] for t in transactions_list if t["type"] == "deposit")
     await user.save()
@@ -145,9 +175,63 @@ async def upload_transactions(file: UploadFile = File(...), Authorize: AuthJWT =
         transaction = Transaction()
         transaction = await process_transactions(user=user, current_user_id=current_user_id, transaction_dict=transaction_dict, transaction=transaction)
         transaction_create.labels(method='POST', endpoint=f"/{transaction}").inc()
+        await publish_transaction(current_user_id, transaction)
+    await mark_write(current_user_id)
+    await publish_balance(current_user_id, user.balance)
     return {"status": "ok", "message": "All transactions saved correctly"}
 
 
+async def run_archive(lock, horizon_days: int):
+    try:
+        archived = await Transaction.archive(horizon_days=horizon_days, lock=lock)
+        logger.info("Archived %s transactions older than %s days", archived, horizon_days)
+    except LockNotOwnedError:
+        logger.error("The archive lock was lost, stopping the archive job")
+    finally:
+        try:
+            await lock.release()
+        except LockError:
+            pass
+
+
+@app.post("/transactions/archive", response_description="Archive old transactions into segment files.", status_code=202)
+async def archive_transactions(background_tasks: BackgroundTasks, horizon_days: int = ARCHIVE_HORIZON_DAYS, Authorize: AuthJWT = Depends()):
+    Authorize.jwt_required()
+    current_profile = Authorize.get_raw_jwt().get('profile')
+    if current_profile != Profile.admin:
+        raise HTTPException(status_code=401, detail="You don´t have permissions to do this action.")
+    if horizon_days <= 0:
+        raise HTTPException(status_code=400, detail="horizon_days must be greater than 0.")
+    # Only one replica at a time can write segments and the index, the job
+    # renews the lock as it goes and runs after the response is sent
+    lock = async_rd.lock("transactions:archive", timeout=ARCHIVE_LOCK_SECONDS)
+    if not await lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="An archive job is already running.")
+    background_tasks.add_task(run_archive, lock, horizon_days)
+    return {"status": "ok", "message": "Archive job started"}
+
+
+@app.get("/transactions/feed", response_description="Stream new transactions and balance changes.")
+async def transactions_feed(request: Request, all_users: bool = False, token: str = None, Authorize: AuthJWT = Depends()):
+    # Browsers' EventSource can't send the Authorization header, so the access token may come as ?token=
+    if token:
+        Authorize.jwt_required(auth_from="websocket", token=token)
+        raw_jwt = Authorize.get_raw_jwt(token)
+    else:
+        Authorize.jwt_required()
+        raw_jwt = Authorize.get_raw_jwt()
+    current_profile = raw_jwt.get('profile')
+    current_user_id = raw_jwt.get('user_id')
+    if all_users:
+        if current_profile != Profile.admin:
+            raise HTTPException(status_code=401, detail="You don´t have permissions to do this action.")
+        current_user_id = None
+    return StreamingResponse(
+        stream_feed(request, user_id=current_user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @app.get("/transactions", response_description="List all transactions.")
 async def list_transactions(order_by: str = "-date", search_by: str = '', search: str = '', from_date: int = None, to_date: int = None, page_size: int = 10, page_number: int = 1, Authorize: AuthJWT = Depends()):
@@ -159,17 +243,7 @@ async def list_transactions(order_by: str = "-date", search_by: str = '', search
     else:
         start = (page_number - 1)  * page_size
     # Planning to add redis here for cacheing queries depending on search_by, order and user
-    orders = {
-        "created": Transaction.created,
-        "-created": Transaction.created.desc(),
-        "description": Transaction.description,
-        "amount": Transaction.amount,
-        "-amount": Transaction.amount.desc(),
-        "date": Transaction.timestamp_date,
-        "-date": Transaction.timestamp_date.desc(),
-        "type": Transaction.type,
-        "id": Transaction.id,
-    }
+    db = await engine_for(current_user_id)
 
     if current_profile == Profile.admin:
         if bool(search):
@@ -181,16 +255,18 @@ async def list_transactions(order_by: str = "-date", search_by: str = '', search
                 start=start, 
                 limit=page_size, 
                 page_number=page_number, 
-                order_by=orders.get(order_by), 
+                order_by=order_by, 
                 user_id=current_user_id, 
-                current_profile=current_profile
+                current_profile=current_profile,
+                db=db
             )
         else:
             transactions = await Transaction.list_all(
-                order_by=orders.get(order_by), 
+                order_by=order_by, 
                 start=start, 
                 limit=page_size, 
-                page_number=page_number
+                page_number=page_number,
+                db=db
             )
         if transactions:
             return transactions
@@ -205,17 +281,19 @@ async def list_transactions(order_by: str = "-date", search_by: str = '', search
                 start=start, 
                 limit=page_size, 
                 page_number=page_number, 
-                order_by=orders.get(order_by), 
+                order_by=order_by, 
                 user_id=current_user_id, 
-                current_profile=current_profile
+                current_profile=current_profile,
+                db=db
             ) 
         else:
             transactions = await Transaction.get_by_user(
-                order_by=orders.get(order_by), 
+                order_by=order_by, 
                 user_id=current_user_id, 
                 start=start, 
                 limit=page_size, 
-                page_number=page_number
+                page_number=page_number,
+                db=db
             )
         if transactions:
             return transactions
@@ -0,0 +1,153 @@
+import os
+import gzip
+import json
+import asyncio
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from bson import json_util
+
+from .settings import ARCHIVE_DIR, ARCHIVE_HORIZON_DAYS, ARCHIVE_CACHE_SEGMENTS
+
+
+INDEX_FILE = "index.json"
+
+_index_cache = {"mtime": None, "by_user": {}, "segments": []}
+
+
+def archive_cutoff(horizon_days: int = ARCHIVE_HORIZON_DAYS) -> int:
+    return int((datetime.utcnow() - timedelta(days=horizon_days)).timestamp())
+
+
+def _index_path() -> str:
+    return os.path.join(ARCHIVE_DIR, INDEX_FILE)
+
+
+def _load_index() -> dict:
+    """
+    The index is only parsed again when the file changes, every replica keeps
+    it in memory grouped by user.
+    """
+    try:
+        mtime = (_index_path(), os.stat(_index_path()).st_mtime_ns)
+    except FileNotFoundError:
+        return {"mtime": None, "by_user": {}, "segments": []}
+    if _index_cache["mtime"] != mtime:
+        with open(_index_path()) as f:
+            segments = json.load(f)
+        by_user = {}
+        for segment in segments:
+            by_user.setdefault(segment["user_id"], []).append(segment)
+        _index_cache.update(mtime=mtime, by_user=by_user, segments=segments)
+    return _index_cache
+
+
+def add_segments(segments: list):
+    if not segments:
+        return
+    path = _index_path()
+    index = []
+    if os.path.exists(path):
+        with open(path) as f:
+            index = json.load(f)
+    index.extend(segments)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_segment(user_id: str, docs: list) -> dict:
+    """
+    Writes the transaction documents of a user into a gzipped NDJSON segment
+    and returns its index entry, to be registered with add_segments.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    dates = [doc["timestamp_date"] for doc in docs]
+    segment = {
+        "file": f"{user_id}-{min(dates)}-{max(dates)}-{int(datetime.utcnow().timestamp())}.ndjson.gz",
+        "user_id": user_id,
+        "from_date": min(dates),
+        "to_date": max(dates),
+        "count": len(docs),
+    }
+    path = os.path.join(ARCHIVE_DIR, segment["file"])
+    with gzip.open(f"{path}.tmp", "wt") as f:
+        for doc in docs:
+            f.write(json_util.dumps(doc) + "\n")
+    os.replace(f"{path}.tmp", path)
+    return segment
+
+
+def overlapping(segments: list, from_date: int = None, to_date: int = None) -> list:
+    result = []
+    for segment in segments:
+        if from_date is not None and segment["to_date"] < from_date:
+            continue
+        if to_date is not None and segment["from_date"] > to_date:
+            continue
+        result.append(segment)
+    return result
+
+
+def _segments(user_id: str = None, from_date: int = None, to_date: int = None) -> list:
+    index = _load_index()
+    candidates = index["segments"] if user_id is None else index["by_user"].get(user_id, [])
+    return overlapping(candidates, from_date=from_date, to_date=to_date)
+
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SEGMENTS)
+def _read_segment(path: str) -> tuple:
+    # Segments are never modified once written, so they can be cached by path
+    with gzip.open(path, "rt") as f:
+        return tuple(json_util.loads(line) for line in f)
+
+
+def _count_segments(segments: list, from_date: int = None, to_date: int = None) -> int:
+    # The index count is exact for segments inside the range, only the edges are read
+    count = 0
+    for segment in segments:
+        inside = (from_date is None or segment["from_date"] >= from_date) and (to_date is None or segment["to_date"] <= to_date)
+        if inside:
+            count += segment["count"]
+        else:
+            count += len(_read_segments([segment], from_date=from_date, to_date=to_date))
+    return count
+
+
+def _archived_ids(user_id: str) -> set:
+    ids = set()
+    for segment in _segments(user_id=user_id):
+        ids.update(doc["_id"] for doc in _read_segment(os.path.join(ARCHIVE_DIR, segment["file"])))
+    return ids
+
+
+def _read_segments(segments: list, from_date: int = None, to_date: int = None) -> list:
+    docs = []
+    for segment in segments:
+        for doc in _read_segment(os.path.join(ARCHIVE_DIR, segment["file"])):
+            if from_date is not None and doc["timestamp_date"] < from_date:
+                continue
+            if to_date is not None and doc["timestamp_date"] > to_date:
+                continue
+            docs.append(dict(doc))
+    return docs
+
+
+async def archived_segments(user_id: str = None, from_date: int = None, to_date: int = None) -> list:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _segments, user_id, from_date, to_date)
+
+
+async def read_archived(segments: list, from_date: int = None, to_date: int = None) -> list:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _read_segments, segments, from_date, to_date)
+
+
+async def count_archived(segments: list, from_date: int = None, to_date: int = None) -> int:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _count_segments, segments, from_date, to_date)
+
+
+async def archived_ids(user_id: str) -> set:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _archived_ids, user_id)
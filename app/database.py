@@ -0,0 +1,59 @@
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from motor.motor_asyncio import AsyncIOMotorClient
+from odmantic import AIOEngine
+
+from .settings import (
+    DATABASE_NAME, DATABASE_URL, READ_PREFERENCE, READ_MAX_STALENESS,
+    READ_YOUR_WRITES_SECONDS, REDIS_HOST, REDIS_PORT, REDIS_TIMEOUT
+)
+
+
+def read_options() -> dict:
+    options = {"readPreference": READ_PREFERENCE}
+    # maxStalenessSeconds is rejected by the driver for the primary read preference
+    if READ_PREFERENCE != "primary":
+        options["maxStalenessSeconds"] = READ_MAX_STALENESS
+    return options
+
+
+client = AsyncIOMotorClient(DATABASE_URL)
+engine = AIOEngine(motor_client=client, database=DATABASE_NAME)
+
+read_client = AsyncIOMotorClient(DATABASE_URL, **read_options())
+read_engine = AIOEngine(motor_client=read_client, database=DATABASE_NAME)
+
+# Short timeouts so the best effort calls made during uploads fail fast when redis is down
+rd = aioredis.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=0,
+    decode_responses=True,
+    socket_timeout=REDIS_TIMEOUT,
+    socket_connect_timeout=REDIS_TIMEOUT
+)
+
+
+def recent_write_key(user_id: str) -> str:
+    return f"recent-write:{user_id}"
+
+
+async def mark_write(user_id: str):
+    try:
+        await rd.set(recent_write_key(user_id), 1, ex=READ_YOUR_WRITES_SECONDS)
+    except RedisError:
+        pass
+
+
+async def engine_for(user_id: str) -> AIOEngine:
+    """
+    Listings and searches go to secondaries, unless the user wrote recently,
+    in that case they read from the primary to see their own writes.
+    """
+    try:
+        recent_write = await rd.exists(recent_write_key(user_id))
+    except RedisError:
+        return engine
+    if recent_write:
+        return engine
+    return read_engine
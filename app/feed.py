@@ -0,0 +1,108 @@
+import json
+import asyncio
+
+from redis.exceptions import RedisError
+
+from .settings import FEED_CHANNEL_PREFIX, FEED_BUFFER_SIZE, FEED_KEEPALIVE
+from .database import rd
+
+
+def feed_channel(user_id: str) -> str:
+    return f"{FEED_CHANNEL_PREFIX}:{user_id}"
+
+
+def format_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def publish_event(user_id: str, event: str, data: dict):
+    # The feed is best effort, ingestion must not fail because redis is down
+    message = json.dumps({"event": event, "user_id": user_id, "data": data})
+    try:
+        await rd.publish(feed_channel(user_id), message)
+    except RedisError:
+        pass
+
+
+async def publish_transaction(user_id: str, transaction):
+    await publish_event(user_id, "transaction", {
+        "id": str(transaction.id),
+        "description": transaction.description,
+        "amount": transaction.amount,
+        "type": transaction.type,
+        "date": transaction.date,
+        "timestamp_date": transaction.timestamp_date,
+        "completed": transaction.completed,
+        "created": transaction.created,
+    })
+
+
+async def publish_balance(user_id: str, balance: float):
+    await publish_event(user_id, "balance", {"balance": balance})
+
+
+class FeedSubscription:
+    """
+    Subscription of a single connection to the feed of one user, or of every
+    user when user_id is None. Messages are buffered in a bounded queue, when a
+    slow consumer fills it the oldest messages are dropped and a "lagged" event
+    tells the client to refetch from GET /transactions.
+    """
+
+    def __init__(self, user_id: str = None, buffer_size: int = FEED_BUFFER_SIZE):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        self.pubsub = rd.pubsub()
+        self.reader = None
+
+    async def start(self):
+        if self.user_id is None:
+            await self.pubsub.psubscribe(feed_channel("*"))
+        else:
+            await self.pubsub.subscribe(feed_channel(self.user_id))
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.pubsub.close()
+
+    async def _read(self):
+        while True:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None or message["type"] not in ("message", "pmessage"):
+                continue
+            if self.queue.full():
+                self.queue.get_nowait()
+                self.dropped += 1
+            self.queue.put_nowait(message["data"])
+
+    async def events(self, request):
+        while not await request.is_disconnected():
+            getter = asyncio.ensure_future(self.queue.get())
+            done, _ = await asyncio.wait({getter, self.reader}, timeout=FEED_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if self.reader in done:
+                    # The pubsub connection is gone, end the stream so the client reconnects
+                    error = None if self.reader.cancelled() else self.reader.exception()
+                    yield format_event("error", {"detail": f"Feed unavailable: {error}"})
+                    return
+                yield ": keepalive\n\n"
+                continue
+            if self.dropped:
+                yield format_event("lagged", {"dropped": self.dropped})
+                self.dropped = 0
+            message = json.loads(getter.result())
+            yield format_event(message["event"], {"user_id": message["user_id"], **message["data"]})
+
+
+async def stream_feed(request, user_id: str = None):
+    subscription = FeedSubscription(user_id=user_id)
+    await subscription.start()
+    try:
+        async for event in subscription.events(request):
+            yield event
+    finally:
+        await subscription.close()
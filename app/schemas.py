@@ -1,17 +1,35 @@
+import heapq
+import asyncio
+
 from enum import Enum
 from datetime import datetime
 from typing import Optional, Any, List
-from motor.motor_asyncio import AsyncIOMotorClient
 from odmantic import Model, AIOEngine, query
 from bson import ObjectId
 
-from .settings import DATABASE_NAME, DATABASE_URL
+from .settings import ARCHIVE_HORIZON_DAYS
+from .database import engine, read_engine
 from .utils import paginated_payload, create_transaction_payload
-from .users import User
-
+from .users import User, Profile
+from .archive import (
+    archive_cutoff, write_segment, add_segments, archived_segments, read_archived,
+    overlapping, count_archived, archived_ids
+)
+
+
+# Sort options of GET /transactions as (field, descending)
+ORDERS = {
+    "created": ("created", False),
+    "-created": ("created", True),
+    "description": ("description", False),
+    "amount": ("amount", False),
+    "-amount": ("amount", True),
+    "date": ("timestamp_date", False),
+    "-date": ("timestamp_date", True),
+    "type": ("type", False),
+    "id": ("id", False),
+}
 
-client = AsyncIOMotorClient(DATABASE_URL)
-engine = AIOEngine(motor_client=client, database=DATABASE_NAME)
 
 class TransactionType(str, Enum):
     deposit = "deposit"
@@ -53,22 +71,94 @@ class Transaction(Model):
         await engine.delete(self)
 
     @classmethod
-    async def list_all(cls, order_by: Any, start, limit, page_number) -> list:
-        transactions = await engine.find(Transaction,skip=start, limit=limit, sort=order_by)
+    async def archive(cls, horizon_days: int = ARCHIVE_HORIZON_DAYS, lock: Any = None) -> int:
+        cutoff = archive_cutoff(horizon_days)
+        collection = engine.get_collection(Transaction)
+        user_ids = await collection.distinct("assigned_id", {"timestamp_date": {"$lt": cutoff}})
+        loop = asyncio.get_event_loop()
+        segments = []
+        to_delete = []
+        archived = 0
+        for user_id in user_ids:
+            # Keep the lock alive while the job runs, it raises if another run took it over
+            if lock is not None:
+                await lock.reacquire()
+            transactions = await engine.find(Transaction, Transaction.assigned_id == user_id, Transaction.timestamp_date < cutoff)
+            # Rows left behind by an interrupted run are already in a segment, they only need deleting
+            already_archived = await archived_ids(user_id)
+            docs = [transaction.doc() for transaction in transactions if transaction.id not in already_archived]
+            if docs:
+                segments.append(await loop.run_in_executor(None, write_segment, user_id, docs))
+                archived += len(docs)
+            to_delete.extend(transaction.id for transaction in transactions)
+        if lock is not None:
+            await lock.reacquire()
+        # The index is written once per run and rows are only removed after it
+        await loop.run_in_executor(None, add_segments, segments)
+        for i in range(0, len(to_delete), 1000):
+            await collection.delete_many({"_id": {"$in": to_delete[i:i + 1000]}})
+        return archived
+
+    @classmethod
+    async def page_with_archive(cls, db: AIOEngine, filters: list, order_by: str, start, limit, segments: list, from_date: int = None, to_date: int = None) -> tuple:
+        # Hot and archived rows are merged under the requested order, so the
+        # first start + limit hot rows are enough to build the page
+        hot = await db.find(Transaction, *filters, sort=transaction_sort(order_by), limit=start + limit)
+        count = await db.count(Transaction, *filters)
+        count += await count_archived(segments, from_date=from_date, to_date=to_date)
+        field, descending = ORDERS.get(order_by, (None, False))
+        read_from, read_to = from_date, to_date
+        if field == "timestamp_date" and len(hot) == start + limit:
+            # Archived rows beyond the last hot row of the page can't be on it
+            boundary = hot[-1].timestamp_date
+            if descending:
+                read_from = boundary if read_from is None else max(read_from, boundary)
+            else:
+                read_to = boundary if read_to is None else min(read_to, boundary)
+        page_segments = overlapping(segments, from_date=read_from, to_date=read_to)
+        if not page_segments:
+            return hot[start:start + limit], count
+        docs = await read_archived(page_segments, from_date=read_from, to_date=read_to)
+        # Between publishing the index and deleting the hot rows, or on a lagging
+        # secondary, rows can be in both places, the hot copy wins
+        duplicated = await db.find(Transaction, *filters, query.in_(Transaction.id, [doc["_id"] for doc in docs]))
+        duplicated_ids = {transaction.id for transaction in duplicated}
+        archived = [Transaction.parse_doc(doc) for doc in docs if doc["_id"] not in duplicated_ids]
+        count -= len(duplicated_ids)
+        if field is not None:
+            key = sort_key(field)
+            archived.sort(key=key, reverse=descending)
+            rows = list(heapq.merge(hot, archived, key=key, reverse=descending))
+        else:
+            rows = hot + archived
+        return rows[start:start + limit], count
+
+    @classmethod
+    async def list_all(cls, order_by: str, start, limit, page_number, db: AIOEngine = read_engine) -> list:
+        segments = await archived_segments()
+        if segments:
+            transactions, count = await cls.page_with_archive(db, [], order_by, start, limit, segments)
+        else:
+            transactions = await db.find(Transaction,skip=start, limit=limit, sort=transaction_sort(order_by))
+            count = await db.count(Transaction)
         transaction_list = []
         for transaction in transactions:
             _transaction = await create_transaction_payload(transaction)
             transaction_list.append(_transaction)
-        count = await engine.count(Transaction)
         end = start + limit
         total_pages = round(count/limit)
         payload_paginated = await paginated_payload(data=transaction_list, count=count, total_pages=total_pages, end=end, page_number=page_number)
         return payload_paginated
 
     @classmethod
-    async def get_by_user(cls, order_by: Any, user_id: str, start, limit, page_number):
-        transaction = await engine.find(Transaction, Transaction.assigned_id == user_id, skip=start, limit=limit, sort=order_by)
-        count = await engine.count(Transaction, Transaction.assigned_id == user_id)
+    async def get_by_user(cls, order_by: str, user_id: str, start, limit, page_number, db: AIOEngine = read_engine):
+        filters = [Transaction.assigned_id == user_id]
+        segments = await archived_segments(user_id=user_id)
+        if segments:
+            transaction, count = await cls.page_with_archive(db, filters, order_by, start, limit, segments)
+        else:
+            transaction = await db.find(Transaction, *filters, skip=start, limit=limit, sort=transaction_sort(order_by))
+            count = await db.count(Transaction, *filters)
         transaction_list = []
         for one_transaction in transaction:
             payload = await create_transaction_payload(one_transaction)
@@ -80,20 +170,48 @@ class Transaction(Model):
 
 
     @classmethod
-    async def search(cls, search:str, search_by: str, from_date: int, to_date: int, start, limit, page_number, order_by: Any, user_id: str, current_profile: Any) -> List:
+    async def search(cls, search:str, search_by: str, from_date: int, to_date: int, start, limit, page_number, order_by: str, user_id: str, current_profile: Any, db: AIOEngine = read_engine) -> List:
+        sort = transaction_sort(order_by)
         if search_by == 'date' and bool(from_date) and bool(to_date):
-            transactions = await engine.find(Transaction, query.and_(Transaction.created >= from_date, Transaction.created <= to_date), sort=order_by)
-            count = await engine.count(Transaction, Transaction.assigned_id == user_id)
+            filters = [Transaction.timestamp_date >= from_date, Transaction.timestamp_date <= to_date]
+            if current_profile != Profile.admin:
+                filters.append(Transaction.assigned_id == user_id)
+            segments = await archived_segments(
+                user_id=user_id if current_profile != Profile.admin else None,
+                from_date=from_date,
+                to_date=to_date
+            )
+            if segments:
+                transactions, count = await cls.page_with_archive(db, filters, order_by, start, limit, segments, from_date=from_date, to_date=to_date)
+            else:
+                transactions = await db.find(Transaction, *filters, sort=sort, skip=start, limit=limit)
+                count = await db.count(Transaction, *filters)
 
         elif search_by == "type":
-            transactions = await engine.find(Transaction, query.match(Transaction.type, f".*{search}.*"), sort=order_by, skip=start, limit=limit)
-            count = await engine.count(Transaction, query.match(Transaction.type, f".*{search}.*"), Transaction.assigned_id == user_id)
+            transactions = await db.find(Transaction, query.match(Transaction.type, f".*{search}.*"), sort=sort, skip=start, limit=limit)
+            count = await db.count(Transaction, query.match(Transaction.type, f".*{search}.*"), Transaction.assigned_id == user_id)
 
         elif search_by == "description":
-            transactions = await engine.find(Transaction, query.match(Transaction.description, f".*{search}.*"), sort=order_by, skip=start, limit=limit)
-            count = await engine.count(Transaction, query.match(Transaction.description, f".*{search}.*"), Transaction.assigned_id == user_id)
+            transactions = await db.find(Transaction, query.match(Transaction.description, f".*{search}.*"), sort=sort, skip=start, limit=limit)
+            count = await db.count(Transaction, query.match(Transaction.description, f".*{search}.*"), Transaction.assigned_id == user_id)
 
         end = start + limit
         total_pages = round(count/limit)
         payload_paginated = await paginated_payload(data=transactions, count=count, total_pages=total_pages, end=end, page_number=page_number)
         return payload_paginated
+
+
+def transaction_sort(order_by: str):
+    if order_by not in ORDERS:
+        return None
+    field, descending = ORDERS[order_by]
+    proxy = getattr(Transaction, field)
+    return proxy.desc() if descending else proxy
+
+
+def sort_key(field: str):
+    # Nulls go first ascending and last descending, like in mongo
+    def key(transaction):
+        value = getattr(transaction, field)
+        return (value is not None, value)
+    return key
@@ -1,17 +1,13 @@
+import re
+
 from enum import Enum
 from odmantic import Model
-from motor.motor_asyncio import AsyncIOMotorClient
-from odmantic import AIOEngine
-from typing import Optional
+from typing import Optional, AsyncIterator
 from passlib.context import CryptContext
 from bson import ObjectId
 from pydantic import BaseModel
 
-from .settings import DATABASE_NAME, DATABASE_URL
-
-
-client = AsyncIOMotorClient(DATABASE_URL)
-engine = AIOEngine(motor_client=client, database=DATABASE_NAME)
+from .database import engine, read_engine
 
 pwd_context = CryptContext(
         schemes=["pbkdf2_sha256"],
@@ -36,6 +32,14 @@ class UserLogin(BaseModel):
     password: str
 
 
+class UserPublic(BaseModel):
+    id: str
+    username: Optional[str]
+    email: Optional[str]
+    profile: Optional[Profile]
+    balance: Optional[float] = 0
+
+
 class User(Model):
     username: Optional[str]
     email: Optional[str]
@@ -63,11 +67,33 @@ class User(Model):
         return user
 
     @classmethod
-    async def all(cls) -> list:
+    async def create_indexes(cls):
+        collection = engine.get_collection(User)
+        await collection.create_index("username")
+        await collection.create_index([("profile", 1), ("_id", 1)])
+
+    @classmethod
+    async def iter_public(cls, after: str = None, limit: int = 0, profile: Profile = None, username_prefix: str = None) -> AsyncIterator[UserPublic]:
+        # Keyset pagination on _id, the password never leaves the database
+        filters = {}
+        if after:
+            filters["_id"] = {"$gt": ObjectId(after)}
+        if profile:
+            filters["profile"] = profile.value
+        if username_prefix:
+            filters["username"] = {"$regex": f"^{re.escape(username_prefix)}"}
+        collection = read_engine.get_collection(User)
+        cursor = collection.find(filters, projection={"password": 0}).sort("_id", 1).limit(limit)
+        async for doc in cursor:
+            doc["id"] = str(doc.pop("_id"))
+            yield UserPublic(**doc)
+
+    @classmethod
+    async def list_public(cls, after: str = None, limit: int = 100, profile: Profile = None, username_prefix: str = None) -> list:
         users = []
-        async for i in engine.find(User,):
-            users.append(i)
+        async for user in cls.iter_public(after=after, limit=limit, profile=profile, username_prefix=username_prefix):
+            users.append(user)
         return users
-    
+
     async def delete(self):
         await engine.delete(self)
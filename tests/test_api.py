@@ -1,8 +1,12 @@
 import pytest
 import json
+import asyncio
+import fnmatch
+import collections
 import tempfile
 
 from fastapi.testclient import TestClient
+from fastapi_jwt_auth import AuthJWT
 from app.app import app
 
 from app.users import User
@@ -15,6 +19,12 @@ def client():
     return client
 
 
+def auth_headers(profile, user_id="640000000000000000000000"):
+    # Signed locally so the endpoint can be tested without logging in against the database
+    token = AuthJWT().create_access_token(subject="testuser", user_claims={"profile": profile, "user_id": user_id, "name": "testuser"})
+    return {"Authorization": f"Bearer {token}"}
+
+
 # Create Superuser API Test
 @pytest.mark.asyncio
 async def test_create_superuser(client):
@@ -98,6 +108,65 @@ async def test_list_users(client):
     assert isinstance(response.json(), list)
 
 
+# List Users NDJSON API Test
+def test_list_users_ndjson(client, monkeypatch):
+    from bson import ObjectId
+    from app import users
+
+    stored = [
+        {"_id": ObjectId(), "username": "admin1", "password": "hash", "profile": "admin", "balance": 0},
+        {"_id": ObjectId(), "username": "admin2", "password": "hash", "profile": "admin", "balance": 10},
+    ]
+    received = {}
+
+    class FakeCursor:
+        def __init__(self, docs):
+            self.docs = docs
+
+        def sort(self, *args):
+            return self
+
+        def limit(self, limit):
+            return self
+
+        async def __aiter__(self):
+            for doc in self.docs:
+                yield doc
+
+    class FakeCollection:
+        def find(self, filters, projection):
+            received.update(filters=filters, projection=projection)
+            excluded = [field for field, value in projection.items() if not value]
+            return FakeCursor([{k: v for k, v in doc.items() if k not in excluded} for doc in stored])
+
+    class FakeEngine:
+        def get_collection(self, model):
+            return FakeCollection()
+
+    monkeypatch.setattr(users, "read_engine", FakeEngine())
+
+    response = client.get(
+        "/users?format=ndjson&profile=admin&username_prefix=adm",
+        headers=auth_headers("admin")
+    )
+    assert response.status_code == 200
+    assert received["projection"] == {"password": 0}
+    assert received["filters"] == {"profile": "admin", "username": {"$regex": "^adm"}}
+    lines = response.text.splitlines()
+    assert len(lines) == 2
+    for line, doc in zip(lines, stored):
+        user = json.loads(line)
+        assert "password" not in user
+        assert user["id"] == str(doc["_id"])
+        assert user["profile"] == "admin"
+
+
+# List Users Permissions API Test
+def test_list_users_requires_admin(client):
+    response = client.get("/users", headers=auth_headers("client"))
+    assert response.status_code == 401
+
+
 # Show User API Test
 @pytest.mark.asyncio
 async def test_show_user(client):
@@ -241,3 +310,327 @@ async def test_list_transactions():
     assert response.json()[0]["amount"] == 500
     assert response.json()[1]["type"] == "withdrawal"
     assert response.json()[1]["amount"] == 200
+
+
+# Transactions Feed API Test
+def test_transactions_feed_all_users_requires_admin(client):
+    response = client.get(
+        "/transactions/feed?all_users=true",
+        headers=auth_headers("client")
+    )
+    assert response.status_code == 401
+
+
+# Transactions Feed Query Token Test
+def test_transactions_feed_accepts_query_token(client):
+    token = auth_headers("client")["Authorization"].split()[1]
+    response = client.get(f"/transactions/feed?all_users=true&token={token}")
+    assert response.status_code == 401
+    assert response.json()["detail"] == "You don´t have permissions to do this action."
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = []
+        self.patterns = []
+        self.messages = collections.deque()
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        if not self.messages:
+            await asyncio.sleep(0.01)
+            return None
+        return self.messages.popleft()
+
+    async def close(self):
+        self.redis.pubsubs.remove(self)
+
+
+class FakeFeedRedis:
+    def __init__(self):
+        self.pubsubs = []
+
+    def pubsub(self):
+        pubsub = FakePubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+    async def publish(self, channel, message):
+        for pubsub in self.pubsubs:
+            if channel in pubsub.channels:
+                pubsub.messages.append({"type": "message", "channel": channel, "data": message})
+            for pattern in pubsub.patterns:
+                if fnmatch.fnmatch(channel, pattern):
+                    pubsub.messages.append({"type": "pmessage", "channel": channel, "data": message})
+
+
+class ConnectedRequest:
+    def __init__(self, checks):
+        self.checks = checks
+
+    async def is_disconnected(self):
+        self.checks -= 1
+        return self.checks < 0
+
+
+async def collect_feed(subscription, checks):
+    await asyncio.sleep(0.05)
+    return [event async for event in subscription.events(ConnectedRequest(checks))]
+
+
+# Transactions Feed Delivery Test
+@pytest.mark.asyncio
+async def test_transactions_feed_delivers_published_events(monkeypatch):
+    from app import feed
+    fake = FakeFeedRedis()
+    monkeypatch.setattr(feed, "rd", fake)
+    monkeypatch.setattr(feed, "FEED_KEEPALIVE", 0.05)
+
+    own = feed.FeedSubscription(user_id="user")
+    admin = feed.FeedSubscription(user_id=None)
+    await own.start()
+    await admin.start()
+    await feed.publish_balance("user", 100.0)
+    await feed.publish_balance("other", 50.0)
+
+    own_events = await collect_feed(own, 2)
+    admin_events = await collect_feed(admin, 3)
+    await own.close()
+    await admin.close()
+
+    assert own_events == [
+        feed.format_event("balance", {"user_id": "user", "balance": 100.0}),
+        ": keepalive\n\n",
+    ]
+    assert admin_events == [
+        feed.format_event("balance", {"user_id": "user", "balance": 100.0}),
+        feed.format_event("balance", {"user_id": "other", "balance": 50.0}),
+        ": keepalive\n\n",
+    ]
+
+
+# Transactions Feed Slow Consumer Test
+@pytest.mark.asyncio
+async def test_transactions_feed_drops_oldest_for_slow_consumers(monkeypatch):
+    from app import feed
+    fake = FakeFeedRedis()
+    monkeypatch.setattr(feed, "rd", fake)
+    monkeypatch.setattr(feed, "FEED_KEEPALIVE", 0.05)
+
+    subscription = feed.FeedSubscription(user_id="user", buffer_size=2)
+    await subscription.start()
+    for balance in range(5):
+        await feed.publish_balance("user", balance)
+
+    events = await collect_feed(subscription, 3)
+    await subscription.close()
+
+    assert events == [
+        feed.format_event("lagged", {"dropped": 3}),
+        feed.format_event("balance", {"user_id": "user", "balance": 3}),
+        feed.format_event("balance", {"user_id": "user", "balance": 4}),
+        ": keepalive\n\n",
+    ]
+
+
+# Transactions Feed Reader Failure Test
+@pytest.mark.asyncio
+async def test_transactions_feed_ends_when_reader_fails():
+    from redis.exceptions import ConnectionError
+    from app.feed import FeedSubscription
+
+    class ConnectedRequest:
+        async def is_disconnected(self):
+            return False
+
+    async def failing_reader():
+        raise ConnectionError("Connection closed by server.")
+
+    subscription = FeedSubscription(user_id="user")
+    subscription.reader = asyncio.ensure_future(failing_reader())
+    events = [event async for event in subscription.events(ConnectedRequest())]
+    assert len(events) == 1
+    assert events[0].startswith("event: error")
+    assert "Connection closed by server." in events[0]
+
+
+# Archive Segments Test
+@pytest.mark.asyncio
+async def test_archive_segments(monkeypatch, tmp_path):
+    from app import archive
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+
+    docs = [
+        {"description": "Salary", "amount": 5000.0, "timestamp_date": 1640995200, "assigned_id": "user"},
+        {"description": "Rent", "amount": 1500.0, "timestamp_date": 1641081600, "assigned_id": "user"},
+    ]
+    segment = archive.write_segment("user", docs)
+    archive.add_segments([segment])
+    assert segment["from_date"] == 1640995200
+    assert segment["to_date"] == 1641081600
+    assert await archive.archived_segments(user_id="other") == []
+    assert await archive.archived_segments(user_id="user", from_date=1641100000) == []
+
+    segments = await archive.archived_segments(user_id="user", from_date=1641000000)
+    archived = await archive.read_archived(segments, from_date=1641000000)
+    assert len(archived) == 1
+    assert archived[0]["description"] == "Rent"
+
+
+class FakeTransactionEngine:
+    def __init__(self, hot, archived):
+        self.hot = hot
+        self.archived_ids = {doc["_id"] for doc in archived}
+
+    async def find(self, model, *filters, sort=None, skip=0, limit=0):
+        # Only the duplicate lookup on archived ids is made without a limit
+        if not limit:
+            return [transaction for transaction in self.hot if transaction.id in self.archived_ids]
+        return self.hot[skip:skip + limit]
+
+    async def count(self, model, *filters):
+        return len(self.hot)
+
+
+async def list_pages(order_by, db, pages=3):
+    rows = []
+    for page_number in range(1, pages + 1):
+        page = await Transaction.get_by_user(
+            order_by=order_by,
+            user_id="user",
+            start=(page_number - 1) * 2,
+            limit=2,
+            page_number=page_number,
+            db=db
+        )
+        rows.append((page["total_items"], page["data"]))
+    return rows
+
+
+@pytest.fixture
+def archive_dir(monkeypatch, tmp_path):
+    from app import archive, schemas
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path))
+
+    async def payload(transaction):
+        return transaction.timestamp_date
+    monkeypatch.setattr(schemas, "create_transaction_payload", payload)
+    return archive
+
+
+def sorted_hot(dates, order_by):
+    return sorted(
+        [Transaction(assigned_id="user", timestamp_date=date) for date in dates],
+        key=lambda transaction: transaction.timestamp_date,
+        reverse=order_by.startswith("-")
+    )
+
+
+# Archive Pagination Test
+@pytest.mark.asyncio
+@pytest.mark.parametrize("order_by, expected", [
+    ("-date", [50, 40, 30, 20, 10]),
+    ("date", [10, 20, 30, 40, 50]),
+])
+async def test_get_by_user_pages_across_archive(archive_dir, order_by, expected):
+    # An upload after the archive run left a hot row older than archived ones
+    hot = sorted_hot((10, 30, 50), order_by)
+    archived = [Transaction(assigned_id="user", timestamp_date=date).doc() for date in (20, 40)]
+    archive_dir.add_segments([archive_dir.write_segment("user", archived)])
+
+    pages = await list_pages(order_by, FakeTransactionEngine(hot, archived))
+    assert [total for total, _ in pages] == [5, 5, 5]
+    assert [row for _, data in pages for row in data] == expected
+
+
+# Archive Recent Page Test
+@pytest.mark.asyncio
+async def test_get_by_user_first_page_skips_archive(archive_dir, monkeypatch):
+    hot = sorted_hot((30, 40, 50), "-date")
+    archived = [Transaction(assigned_id="user", timestamp_date=date).doc() for date in (10, 20)]
+    archive_dir.add_segments([archive_dir.write_segment("user", archived)])
+
+    def read_segment(path):
+        raise AssertionError(f"{path} should not be read")
+    monkeypatch.setattr(archive_dir, "_read_segment", read_segment)
+
+    pages = await list_pages("-date", FakeTransactionEngine(hot, archived), pages=1)
+    assert pages == [(5, [50, 40])]
+
+
+# Archive Duplicates Test
+@pytest.mark.asyncio
+async def test_get_by_user_deduplicates_archived_rows(archive_dir):
+    # An interrupted run published a segment but did not delete the hot copy of 20
+    hot = sorted_hot((20, 30, 50), "-date")
+    archived = [hot[2].doc(), Transaction(assigned_id="user", timestamp_date=10).doc()]
+    archive_dir.add_segments([archive_dir.write_segment("user", archived)])
+
+    pages = await list_pages("-date", FakeTransactionEngine(hot, archived))
+    assert [row for _, data in pages for row in data] == [50, 30, 20, 10]
+    assert pages[-1][0] == 4
+
+
+# Archive Horizon API Test
+def test_archive_rejects_non_positive_horizon(client):
+    response = client.post("/transactions/archive?horizon_days=0", headers=auth_headers("admin"))
+    assert response.status_code == 400
+
+
+# Read Routing Test
+def test_read_options(monkeypatch):
+    from app import database
+    monkeypatch.setattr(database, "READ_PREFERENCE", "secondaryPreferred")
+    assert database.read_options() == {"readPreference": "secondaryPreferred", "maxStalenessSeconds": database.READ_MAX_STALENESS}
+    monkeypatch.setattr(database, "READ_PREFERENCE", "primary")
+    assert database.read_options() == {"readPreference": "primary"}
+
+
+# Read Your Writes Test
+@pytest.mark.asyncio
+async def test_engine_for_reads_own_writes_from_primary(monkeypatch):
+    from redis.exceptions import ConnectionError
+    from app import database
+
+    class FakeRedis:
+        def __init__(self):
+            self.keys = set()
+            self.down = False
+
+        async def set(self, key, value, ex=None):
+            self.keys.add(key)
+
+        async def exists(self, key):
+            if self.down:
+                raise ConnectionError("Connection refused.")
+            return int(key in self.keys)
+
+    fake = FakeRedis()
+    monkeypatch.setattr(database, "rd", fake)
+
+    assert await database.engine_for("user") is database.read_engine
+
+    await database.mark_write("user")
+    assert await database.engine_for("user") is database.engine
+    assert await database.engine_for("other") is database.read_engine
+
+    fake.down = True
+    assert await database.engine_for("other") is database.engine
+
+
+# Read Staleness Settings Test
+def test_read_max_staleness_is_clamped(monkeypatch):
+    import importlib
+    from app import settings
+    monkeypatch.setenv("READ_MAX_STALENESS", "10")
+    assert importlib.reload(settings).READ_MAX_STALENESS == 90
+    monkeypatch.setenv("READ_MAX_STALENESS", "120")
+    assert importlib.reload(settings).READ_MAX_STALENESS == 120
+    monkeypatch.delenv("READ_MAX_STALENESS")
+    importlib.reload(settings)